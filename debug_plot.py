@@ -1,21 +1,22 @@
 from typing import List
 
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import cartopy.io.img_tiles as cimgt
-
 import h3
 
-import shapely.geometry
-from shapely.geometry import Polygon
-
 import s2sphere
 
+# matplotlib, cartopy and shapely are slow to import and only needed when actually
+# plotting, so they're imported inside the functions to keep importing this module cheap
+
 
 def plotFootprintH3(lat: float, lon: float, h3_cells: List):
     """Uses cartopy to replot the footprint, mostly used for debugging and validating
     math and library usage
     """
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+    import cartopy.io.img_tiles as cimgt
+    from shapely.geometry import Polygon
+
     proj = cimgt.Stamen('terrain-background')
     plt.figure(figsize=(6, 6), dpi=400)
     ax = plt.axes(projection=ccrs.PlateCarree(central_longitude=180))
@@ -41,6 +42,10 @@ def plotFootprintH3(lat: float, lon: float, h3_cells: List):
 def plotFootprint(lat: float, lon: float, cells: List):
     """Uses cartopy to replot the footprint, mostly used for debugging and validating
     math and library usage"""
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+    import cartopy.io.img_tiles as cimgt
+    from shapely.geometry import Polygon
 
     proj = cimgt.Stamen('terrain-background')
     plt.figure(figsize=(6, 6), dpi=400)
@@ -2,23 +2,25 @@
 
 from skyfield import api
 from skyfield.api import Loader
+from skyfield.sgp4lib import theta_GMST1982
+from sgp4.api import SatrecArray, jday
 
+import os
 import sys
 import math
 import json
 import itertools
-from collections import defaultdict
+import functools
+import multiprocessing
 
-from typing import List, Dict, DefaultDict, Set, Tuple
+from typing import List, Dict, Tuple, Union
 
 import s2sphere
 
 import numpy as np
 
-import shapely.geometry
-from shapely.geometry import Polygon
-import geog
-import h3
+# integer H3 indices in numpy arrays rather than sets of hex strings
+import h3.api.numpy_int as h3
 
 import requests
 import csv
@@ -27,9 +29,26 @@ from datetime import datetime
 # optional for debugging
 import debug_plot
 
+# optional, compiles the footprint generation when available
+try:
+    from numba import njit, prange, set_num_threads
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
 TLE_URL = 'https://celestrak.com/NORAD/elements/starlink.txt'
 R_MEAN = 6378.1  # km
+WGS84_A = 6378.137  # km
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+WGS84_EP2 = WGS84_E2 / (1 - WGS84_E2)
 H3_RESOLUTION_LEVEL = 4
+MAX_CELLS_PER_SAT = 2000  # a generous bound on the res 4 cells under one footprint
 MIN_TERMINAL_ANGLE_DEG = 35
 
 
@@ -53,7 +72,6 @@ def load_sats() -> List:
 def filter_sats(sats: List) -> List:
     """From https://www.space-track.org/documentation#faq filter to our best
     understanding of what the operational satellites are"""
-    op_sats: List = []
     failures_url = "https://docs.google.com/spreadsheets/d/1mTPX5JSkeaoViGT_1wigrjwjzIVkpzI3xhFpEm909oM/gviz/tq?gid=71799984&tqx=out:csv"
     r = requests.get(failures_url)
     nonoperational = set()
@@ -62,20 +80,54 @@ def filter_sats(sats: List) -> List:
         event_date = datetime.strptime(row['DATE'], "%m/%d/%Y").date()
         event = row['EVENT'].strip()
         nonoperational.add(name)
-    for sat in sats:
-        n = (sat.model.no_kozai / (2 * math.pi)) * 1440
-        e = sat.model.ecco
-        period = 1440/n
-        mu = 398600.4418  # earth grav constant
-        a = (mu/(n*2*math.pi/(24*3600)) ** 2) ** (1./3.)  # semi-major axis
-        # Using semi-major axis "a", eccentricity "e", and the Earth's radius in km,
-        perigee = (a * (1 - e)) - 6378.135
-        if perigee > 540 and sat.name not in nonoperational:
-            op_sats.append(sat)
+    # pull the elements out into arrays once so the orbit math runs over every sat at once
+    names = np.array([sat.name for sat in sats])
+    no_kozai = np.array([sat.model.no_kozai for sat in sats])
+    e = np.array([sat.model.ecco for sat in sats])
+    n = (no_kozai / (2 * math.pi)) * 1440
+    mu = 398600.4418  # earth grav constant
+    a = (mu/(n*2*math.pi/(24*3600)) ** 2) ** (1./3.)  # semi-major axis
+    # Using semi-major axis "a", eccentricity "e", and the Earth's radius in km,
+    perigee = (a * (1 - e)) - 6378.135
+    mask = (perigee > 540) & ~np.isin(names, list(nonoperational))
+    op_sats = [sat for sat, keep in zip(sats, mask) if keep]
 
     return op_sats
 
 
+def itrf_to_geodetic(positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Converts an (..., 3) array of ITRF positions in km to WGS84 latitude, longitude
+    and altitude using Bowring's closed form, which is plenty accurate at LEO altitudes
+    """
+    x, y, z = positions[..., 0], positions[..., 1], positions[..., 2]
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * WGS84_A, p * WGS84_B)
+    lat = np.arctan2(z + WGS84_EP2 * WGS84_B * np.sin(theta) ** 3,
+                     p - WGS84_E2 * WGS84_A * np.cos(theta) ** 3)
+    lon = np.arctan2(y, x)
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(lat) ** 2)
+    alt = p / np.cos(lat) - n
+    return (np.degrees(lat), np.degrees(lon), alt)
+
+
+def propagate_subpoints(satrecs: SatrecArray, jd: np.ndarray, fr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Propagates every satellite in `satrecs` to each UTC Julian date jd + fr with a single
+    batched SGP4 call and returns the (lat_deg, lon_deg, alt_km) arrays of their subpoints,
+    shaped (len(jd), len(satrecs)). Satellites SGP4 fails on come back as NaN
+    """
+    errors, positions, _ = satrecs.sgp4(jd, fr)
+    # TEME -> ITRF is (ignoring polar motion) a rotation about z by the sidereal angle
+    theta, _ = theta_GMST1982(jd, fr)
+    c, s = np.cos(theta), np.sin(theta)
+    rotation = np.zeros((len(theta), 3, 3))
+    rotation[:, 0, 0], rotation[:, 0, 1] = c, s
+    rotation[:, 1, 0], rotation[:, 1, 1] = -s, c
+    rotation[:, 2, 2] = 1.0
+    positions = np.einsum('tij,stj->tsi', rotation, positions)
+    positions[errors.T != 0] = np.nan
+    return itrf_to_geodetic(positions)
+
+
 def calcAreaSpherical(altitude: float, term_angle: float) -> float:
     """Calculates the area of a Starlink satellite using the
     spherical earth model, a satellite (for altitude), and
@@ -93,16 +145,23 @@ def calcAreaSpherical(altitude: float, term_angle: float) -> float:
     return area
 
 
-def calcCapAngle(altitude: float, term_angle: float) -> float:
-    """Returns the cap angle (lambda_FOV/2) in radians"""
-    epsilon = to_rads(term_angle)
+@functools.lru_cache(maxsize=None)
+def capAngleTerms(term_angle: float) -> Tuple[float, float]:
+    """Returns the altitude independent terms of the cap angle for a minimum
+    terminal angle, (pi - (epsilon + 90deg), sin(epsilon + 90deg) * R_MEAN), so the
+    cap angle is just pi_minus_epr - asin(sin_epr_r / (R_MEAN + altitude)). Every
+    call site uses the same handful of terminal angles so these only get computed once"""
+    epsilon_right = to_rads(term_angle) + RIGHT_ANGLE
+    return (math.pi - epsilon_right, math.sin(epsilon_right) * R_MEAN)
 
-    eta_FOV = math.asin((math.sin(epsilon + RIGHT_ANGLE)
-                         * R_MEAN) / (R_MEAN + altitude))
 
-    lambda_FOV = 2 * (math.pi - (epsilon + RIGHT_ANGLE + eta_FOV))
+def calcCapAngle(altitude: Union[float, np.ndarray], term_angle: float) -> Union[float, np.ndarray]:
+    """Returns the cap angle (lambda_FOV/2) in radians. `altitude` may be an array of
+    altitudes in km, in which case an array of cap angles is returned"""
+    pi_minus_epr, sin_epr_r = capAngleTerms(term_angle)
 
-    return (lambda_FOV / 2)
+    # lambda_FOV / 2 = pi - (epsilon + 90deg + eta_FOV)
+    return pi_minus_epr - np.arcsin(sin_epr_r / (R_MEAN + altitude))
 
 
 def get_cell_ids(lat, lng, angle):
@@ -116,83 +175,120 @@ def get_cell_ids(lat, lng, angle):
     return cells
 
 
-def split_antimeridian_polygon(polygon: List[List[float]]) -> Tuple[List, List]:
-    """Takes a GeoJSON formatted list of vertex coordinates List[[lon,lat]]
+def split_antimeridian_polygon(polygon: np.ndarray) -> Tuple[Dict, Dict]:
+    """Takes a closed GeoJSON formatted array of vertex coordinates [[lon,lat]]
     and checks if the longitude crosses over the antimeridian. It splits the polygon
     in 2 at the antimeridian. See: https://github.com/uber/h3/issues/210
     """
-
+    # Drop the closing vertex, the edge back to the start comes from rolling the arrays
+    ring = polygon[:-1]
+    lons, lats = ring[:, 0], ring[:, 1]
+    next_lons, next_lats = np.roll(lons, -1), np.roll(lats, -1)
+    outside = np.abs(lons) > 180
     # We split the polygon into 2. lon < 180 goes into poly1
-    poly1, poly2 = [], []
-    split_loc = 0.0
-    has_split = False
-    for idx in range(len(polygon)-1):
-        first = polygon[idx]
-        second = polygon[idx+1]
-        if (abs(first[0]) < 180 and abs(second[0]) > 180) or (abs(first[0]) > 180 and abs(second[0]) < 180):
-            split_loc = math.copysign(180.0, first[0])
-            # split
-            new_lat = np.interp([split_loc], np.array([first[0], second[0]]),
-                                np.array([first[1], second[1]]))[0]
-            new_point = [split_loc, float(new_lat)]
-            poly1.append([split_loc, float(new_lat)])
-            poly2.append([split_loc, float(new_lat)])
-        elif abs(first[0]) < 180:
-            poly1.append(first)
-        else:
-            poly2.append(first)
+    crossings = np.flatnonzero(outside != np.roll(outside, -1))
+    split_loc = math.copysign(180.0, lons[outside][0])
+    # interpolate the latitude where each crossing edge meets the antimeridian
+    t = (split_loc - lons[crossings]) / (next_lons[crossings] - lons[crossings])
+    new_points = np.column_stack((np.full(len(crossings), split_loc),
+                                  lats[crossings] + t * (next_lats[crossings] - lats[crossings])))
+    # the split points go in after the vertex that starts their edge and belong to both halves
+    points = np.insert(ring, crossings + 1, new_points, axis=0)
+    on_split = np.insert(np.zeros(len(ring), dtype=bool), crossings + 1, True)
+    points_outside = np.insert(outside, crossings + 1, False)
+    poly1 = points[~points_outside]
+    poly2 = points[points_outside | on_split]
     # GeoJSON polygons must have the same point for the first and last vertex
-    poly1.append(poly1[0])
-    poly2.append(poly2[0])
+    poly1 = np.concatenate((poly1, poly1[:1]))
+    poly2 = np.concatenate((poly2, poly2[:1]))
     # h3 doesn't like |longitude| > 180 so make them the negative or positive equivalent
-    poly2_wrapped: List[List[float]] = []
-    for point in poly2:
-        if split_loc > 0:
-            poly2_wrapped.append([-180 + (point[0]-180), point[1]])
-        else:
-            poly2_wrapped.append([180 + (point[0]+180), point[1]])
-    mapping1 = shapely.geometry.mapping(shapely.geometry.Polygon(poly1))
-    mapping2 = shapely.geometry.mapping(
-        shapely.geometry.polygon.orient(shapely.geometry.Polygon(poly2_wrapped), 1.0))
+    poly2_wrapped = poly2.copy()
+    poly2_wrapped[:, 0] -= math.copysign(360.0, split_loc)
+    # orient poly2 counter-clockwise, i.e. with a positive shoelace area
+    signed_area = 0.5 * np.sum(poly2_wrapped[:-1, 0] * poly2_wrapped[1:, 1]
+                               - poly2_wrapped[1:, 0] * poly2_wrapped[:-1, 1])
+    if signed_area < 0:
+        poly2_wrapped = poly2_wrapped[::-1]
+    mapping1 = {"type": "Polygon", "coordinates": [poly1.tolist()]}
+    mapping2 = {"type": "Polygon", "coordinates": [poly2_wrapped.tolist()]}
 
     return (mapping1, mapping2)
 
 
-def get_cell_ids_h3(lat: float, lng: float, angle: float) -> Set:
-    p = shapely.geometry.Point([lng, lat])
-    # so to more accurately match projections maybe arc length of a sphere would be best?
-    arc_length = R_MEAN * angle  # in km
-
-    n_points = 20
-    # arc_length should be in kilometers so convert to meters
-    d = arc_length * 1000  # meters
-    angles = np.linspace(0, 360, n_points)
-    polygon = geog.propagate(p, angles, d)
-    try:
-        mapping = shapely.geometry.mapping(shapely.geometry.Polygon(polygon))
-    except ValueError as e:
-        print(f"lat:{lat}, lng:{lng}")
-        print(polygon)
-
-    cells = set()
-    needs_split = False
-
-    for point in polygon:
-        if point[0] > 180 or point[0] < -180:
-            needs_split = True
-            break
+def footprint_polygons(lat: np.ndarray, lng: np.ndarray, angle: np.ndarray, n_points: int = 20) -> np.ndarray:
+    """Returns an (..., n_points, 2) array of GeoJSON [lon, lat] vertices tracing the
+    boundary of each satellite's spherical cap, using the destination point formula
+    with `angle` (radians) as the angular distance from each subpoint. The first and
+    last vertex are the same so every polygon is closed. Longitudes are not wrapped
+    and may fall outside [-180, 180] near the antimeridian
+    """
+    lat1 = np.radians(lat)[..., np.newaxis]
+    lng1 = np.radians(lng)[..., np.newaxis]
+    delta = np.asarray(angle)[..., np.newaxis]
+    bearings = np.radians(np.linspace(0, 360, n_points))
+
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_delta, cos_delta = np.sin(delta), np.cos(delta)
+    lat2 = np.arcsin(sin_lat1 * cos_delta + cos_lat1 * sin_delta * np.cos(bearings))
+    lng2 = lng1 + np.arctan2(np.sin(bearings) * sin_delta * cos_lat1,
+                             cos_delta - sin_lat1 * np.sin(lat2))
+
+    return np.stack((np.degrees(lng2), np.degrees(lat2)), axis=-1)
+
+
+@njit(parallel=True, cache=True)
+def _footprint_kernel(lat, lng, alt, pi_minus_epr, sin_epr_r, bearings, out):
+    """Fused calcCapAngle + footprint_polygons over a (T, S) grid of subpoints,
+    writing the vertices into the preallocated (T, S, n_points, 2) `out`"""
+    n_times, n_sats = lat.shape
+    for k in prange(n_times * n_sats):
+        i = k // n_sats
+        s = k % n_sats
+        delta = pi_minus_epr - math.asin(sin_epr_r / (R_MEAN + alt[i, s]))
+        sin_delta, cos_delta = math.sin(delta), math.cos(delta)
+        lat1, lng1 = math.radians(lat[i, s]), math.radians(lng[i, s])
+        sin_lat1, cos_lat1 = math.sin(lat1), math.cos(lat1)
+        for b in range(bearings.shape[0]):
+            lat2 = math.asin(sin_lat1 * cos_delta + cos_lat1 * sin_delta * math.cos(bearings[b]))
+            lng2 = lng1 + math.atan2(math.sin(bearings[b]) * sin_delta * cos_lat1,
+                                     cos_delta - sin_lat1 * math.sin(lat2))
+            out[i, s, b, 0] = math.degrees(lng2)
+            out[i, s, b, 1] = math.degrees(lat2)
+
+
+def footprint_polygons_batch(lat: np.ndarray, lng: np.ndarray, alt: np.ndarray,
+                             term_angle: float, n_points: int = 20) -> np.ndarray:
+    """Computes the cap angles and footprint polygons for (T, S) arrays of subpoints
+    from propagate_subpoints, returning a (T, S, n_points, 2) array of vertices.
+    Uses the numba kernel when numba is installed, otherwise plain NumPy"""
+    if not HAVE_NUMBA:
+        return footprint_polygons(lat, lng, calcCapAngle(alt, term_angle), n_points)
+    pi_minus_epr, sin_epr_r = capAngleTerms(term_angle)
+    bearings = np.radians(np.linspace(0, 360, n_points))
+    out = np.empty(lat.shape + (n_points, 2))
+    _footprint_kernel(lat, lng, alt, pi_minus_epr, sin_epr_r, bearings, out)
+    return out
+
+
+def footprint_mappings(polygon: np.ndarray) -> List[Dict]:
+    """Takes a single footprint polygon from footprint_polygons and returns the
+    GeoJSON polygon(s) to polyfill, split in 2 if it crosses the antimeridian"""
+    lon = polygon[:, 0]
+    needs_split = lon.max() > 180 or lon.min() < -180
 
     if needs_split:
         try:
-            (first, second) = split_antimeridian_polygon(polygon)
-            cells.update(h3.polyfill(first, H3_RESOLUTION_LEVEL, True))
-            cells.update(h3.polyfill(second, H3_RESOLUTION_LEVEL, True))
+            return list(split_antimeridian_polygon(polygon))
         except:
-            print(f"lat:{lat}, lng:{lng}")
-    else:
-        cells = h3.polyfill(mapping, H3_RESOLUTION_LEVEL, True)
+            print(polygon)
+            return []
+    # the polygon is already closed so it can go to h3 as GeoJSON as-is
+    return [{"type": "Polygon", "coordinates": [polygon.tolist()]}]
 
-    return cells
+
+def polyfill_mapping(mapping: Dict) -> np.ndarray:
+    """Polyfills a GeoJSON polygon and returns the H3 cells as a uint64 array"""
+    return h3.polyfill(mapping, H3_RESOLUTION_LEVEL, True)
 
 
 sats = load_sats()
@@ -200,59 +296,82 @@ print(f"Loaded {len(sats)} satellites")
 
 op_sats = filter_sats(sats)
 print(f"Filtered to {len(op_sats)} operational satellites")
+satrecs = SatrecArray([sat.model for sat in op_sats])
 ts = api.load.timescale()
-now = ts.now()
 
-subpoints = {sat.name: sat.at(now).subpoint() for sat in op_sats}
 
-sat1 = subpoints['STARLINK-1284']
-angle = calcCapAngle(sat1.elevation.km, 35)
-
-coverage: DefaultDict[str, int] = defaultdict(int)
-
-
-def readTokens():
+def readTokens() -> Dict[str, int]:
+    coverage: Dict[str, int] = {}
     with open('cell_ids.txt', 'r') as fd:
         lines = fd.readlines()
         for line in lines:
             tok = line.strip()
             coverage[tok] = 0
+    return coverage
 
 
 def readH3Indices() -> List[str]:
-    with open('h3_5_index.txt', 'r') as fd:
+    with open(f'h3_{H3_RESOLUTION_LEVEL}_index.txt', 'r') as fd:
         lines = [line.strip() for line in fd.readlines()]
     return lines
 
 
+def readH3Universe() -> np.ndarray:
+    """Returns every H3 index at H3_RESOLUTION_LEVEL as a sorted uint64 array, so the
+    row of a cell in the coverage counter can be found with np.searchsorted"""
+    return np.sort(np.fromiter((h3.string_to_h3(cell) for cell in readH3Indices()),
+                               dtype=np.uint64))
+
+
+def init_worker():
+    """The pool already puts a worker on every core, so keep each worker to one
+    thread rather than letting numba start another cpu_count() threads in each"""
+    if HAVE_NUMBA:
+        set_num_threads(1)
+
+
+def process_minute_range(minutes: range) -> np.ndarray:
+    """Counts, for every cell in cell_universe, how many of `minutes` (minutes after
+    midnight on the simulated day) it spends under at least one satellite. Runs in a
+    forked worker so it reads satrecs, op_sats and cell_universe from the parent"""
+    print(ts.utc(2020, 7, 25, 0, minutes.start, 0).utc_iso())
+    # a cell can be covered at most once a minute, so 16 bits per cell is plenty
+    coverage = np.zeros(len(cell_universe), dtype=np.uint16)
+    # reused every minute, cells covered that minute are written up to a cursor
+    scratch = np.empty(len(op_sats) * MAX_CELLS_PER_SAT, dtype=np.uint64)
+    jd, day_fr = jday(2020, 7, 25, 0, 0, 0)
+    fr = day_fr + np.arange(minutes.start, minutes.stop) * 60.0 / 86400.0
+    lat_deg, lon_deg, alt_km = propagate_subpoints(satrecs, np.full(len(fr), jd), fr)
+    polygons = footprint_polygons_batch(lat_deg, lon_deg, alt_km, MIN_TERMINAL_ANGLE_DEG)
+    for i in range(len(fr)):
+        mappings = [mapping
+                    for idx in range(len(op_sats)) if np.isfinite(alt_km[i, idx])
+                    for mapping in footprint_mappings(polygons[i, idx])]
+        cursor = 0
+        for cells in (polyfill_mapping(mapping) for mapping in mappings):
+            if cursor + len(cells) > len(scratch):
+                scratch = np.resize(scratch, max(2 * len(scratch), cursor + len(cells)))
+            scratch[cursor:cursor + len(cells)] = cells
+            cursor += len(cells)
+        # cells under more than one satellite show up more than once, but a fancy
+        # indexed += is buffered so each row still only goes up by 1 per minute
+        coverage[np.searchsorted(cell_universe, scratch[:cursor])] += 1
+    return coverage
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
-        process: int = int(sys.argv[1])
-    else:
-        process = 0
-    if len(sys.argv) > 2:
-        MIN_TERMINAL_ANGLE_DEG = int(sys.argv[2])
-
-    TIME_PER_PROCESS = 1440 // 4  # 360 minutes, a quarter of a day
-    START_TIME = process * TIME_PER_PROCESS
-    # Consider swapping the loop to be sats then time for cache reasons?
-    for i in range(TIME_PER_PROCESS):
-        time = ts.utc(2020, 7, 25, 0, START_TIME+i, 0)
-        if i % 30 == 0:
-            print(time.utc_iso())
-        subpoints = {sat.name: sat.at(time).subpoint() for sat in op_sats}
-        coverage_set: Set[str] = set()
-        for sat_name, sat in subpoints.items():
-            angle = calcCapAngle(sat.elevation.km, MIN_TERMINAL_ANGLE_DEG)
-            cells = get_cell_ids_h3(sat.latitude.degrees,
-                                    sat.longitude.degrees, angle)
-            if len(cells) == 0:
-                Exception("empty region returned")
-            for cell in cells:
-                coverage_set.add(cell)
-        for cell in coverage_set:
-            coverage[cell] += 1
-
-    with open(f"h3_{H3_RESOLUTION_LEVEL}_cov_{process}.txt", "w") as fd:
-        for cell, cov in coverage.items():
-            fd.write(f"{cell},{cov}\n")
+        MIN_TERMINAL_ANGLE_DEG = int(sys.argv[1])
+
+    DAY_MINUTES = 1440
+    BLOCK_MINUTES = 30  # minutes propagated and turned into footprints at once
+    cell_universe = readH3Universe()
+    chunks = [range(start, min(start + BLOCK_MINUTES, DAY_MINUTES))
+              for start in range(0, DAY_MINUTES, BLOCK_MINUTES)]
+    # fork so the workers share the loaded satellites instead of each reloading them
+    with multiprocessing.get_context('fork').Pool(os.cpu_count(), initializer=init_worker) as pool:
+        coverage = np.sum(pool.map(process_minute_range, chunks), axis=0)
+
+    with open(f"h3_{H3_RESOLUTION_LEVEL}_cov.txt", "w") as fd:
+        for row in np.flatnonzero(coverage):
+            fd.write(f"{h3.h3_to_string(int(cell_universe[row]))},{coverage[row]}\n")
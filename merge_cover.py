@@ -9,12 +9,11 @@ with open(f"h3_4_index.txt", "r") as fd:
     lines = fd.readlines()
     coverage = {line.strip(): 0 for line in lines}
 print(len(coverage))
-for i in range(4):
-    with open(f"h3_4_cov_{i}.txt", "r") as fd:
-        lines = fd.readlines()
-        for line in lines:
-            [index, val] = line.strip().split(',')
-            coverage[index] += int(val)
+with open(f"h3_4_cov.txt", "r") as fd:
+    lines = fd.readlines()
+    for line in lines:
+        [index, val] = line.strip().split(',')
+        coverage[index] += int(val)
 
 with open(f"h3_4_cov_full.txt", "w") as fd:
     for idx, val in coverage.items():